@@ -1,4 +1,5 @@
 import re
+from functools import lru_cache
 
 # ===== 路径配置 =====
 ROOT_FILE = "parts.txt"          # 字根表
@@ -7,6 +8,10 @@ OUTPUT_FILE = "output.txt"       # 生成的码表
 MISSING_LOG = "missing.log"      # 缺失字根日志
 SINGLECODE_LOG = "singlecode.log"  # 单码失败日志
 
+# ===== 写出配置 =====
+WRITE_BUFFER = 1 << 20           # 输出文件缓冲区大小
+WRITE_BATCH = 4096               # 码表每攒够多少行批量写出一次
+
 # ===== 特殊替换规则 =====
 REPLACEMENTS = {
     "甘一": "其上",
@@ -14,12 +19,47 @@ REPLACEMENTS = {
     "于八": "余下",
 }
 
-def apply_replacements(parts):
-    """应用替换规则"""
-    s = "".join(parts)
+_REPL_RE = re.compile("|".join(map(re.escape, REPLACEMENTS)))
+_REPL_HEADS = frozenset(k[0] for k in REPLACEMENTS)
+
+
+def _build_repl_automaton():
+    """用 REPLACEMENTS 构建 Aho-Corasick 自动机；未安装 pyahocorasick 时返回 None"""
+    try:
+        import ahocorasick
+    except ImportError:
+        return None
+    automaton = ahocorasick.Automaton()
     for k, v in REPLACEMENTS.items():
-        s = s.replace(k, v)
-    return list(s)  # 拆成部件列表
+        automaton.add_word(k, (len(k), v))
+    automaton.make_automaton()
+    return automaton
+
+
+_REPL_AUTOMATON = _build_repl_automaton()
+
+
+def _replace_all(s):
+    """一次扫描替换所有规则（最长不重叠匹配）"""
+    if _REPL_AUTOMATON is None:
+        return _REPL_RE.sub(lambda m: REPLACEMENTS[m.group(0)], s)
+    pieces = []
+    pos = 0
+    for end, (length, value) in _REPL_AUTOMATON.iter_long(s):
+        pieces.append(s[pos:end + 1 - length])
+        pieces.append(value)
+        pos = end + 1
+    pieces.append(s[pos:])
+    return "".join(pieces)
+
+
+@lru_cache(maxsize=4096)
+def apply_replacements(parts):
+    """应用替换规则；parts 为部件元组（需可哈希以便缓存）"""
+    # 不含任何规则首字时无需替换，直接返回
+    if _REPL_HEADS.isdisjoint(parts):
+        return parts
+    return tuple(_replace_all("".join(parts)))  # 拆成部件元组
 
 
 # ===== 文件读取 =====
@@ -38,7 +78,7 @@ def load_roots(path):
 
 
 def load_decomposition(path):
-    """加载拆分库"""
+    """加载拆分库；每种拆分方式为部件元组（只读、可哈希）"""
     decomposition = {}
     with open(path, encoding="utf-8") as f:
         for line in f:
@@ -46,61 +86,150 @@ def load_decomposition(path):
             if not line:
                 continue
             char, *parts = line.split("\t")
-            decomposition[char] = [list(p) for p in parts]
+            decomposition[char] = tuple(tuple(p) for p in parts)
     return decomposition
 
 
 # ===== 拆分与取码 =====
-def expand_part(part, decomposition, rootmap, visited, missing_roots):
-    """递归展开某个部件，直到落到字根表或失败"""
-    if part in rootmap:
-        return [part]
-    if part in visited:
-        return None  # 避免死循环
-    visited.add(part)
-
-    if part in decomposition:
-        for sub_parts in decomposition[part]:
-            sub_parts = apply_replacements(sub_parts)
-            expanded = []
-            success = True
-            for sp in sub_parts:
-                res = expand_part(sp, decomposition, rootmap, visited, missing_roots)
+_UNKNOWN = object()  # 缓存未命中标记
+
+
+def make_expander(decomposition, rootmap, missing_roots):
+    """绑定拆分库与字根表，返回带缓存的部件展开函数
+
+    每次顶层展开都从空的已访问集合开始，而拆分库与字根表加载后只读，
+    因此同一部件的顶层展开结果是确定的，按部件缓存（包括失败结果）。
+    缓存中直接存放字根对应的编码，取码时无需再查字根表。
+
+    展开途中的子部件结果受已访问集合影响，只有未被“进入它之前就已访问”
+    的部件截断过的结果才缓存，并连同展开中进入的部件一起保存；复用时要求
+    这些部件当前均未访问，再把它们标记为已访问。
+    """
+    cache = {}  # 部件 -> (字根编码元组或 None, 展开中进入的部件)
+    # 本次顶层展开中进入过的部件 -> 进入次序，避免死循环。与最初的递归实现
+    # 一致：进入后不随回溯移除；各次展开复用同一组容器
+    visited = {}
+    order = []
+
+    def enter(part):
+        visited[part] = len(order)
+        order.append(part)
+
+    def leave(stack, res):
+        """弹出栈顶部件并返回其结果；结果与上下文无关时写入缓存"""
+        name, _, _, _, _, start, cut = stack.pop()
+        if cut >= start:
+            cache[name] = (res, frozenset(order[start:]))
+        if stack and cut < stack[-1][6]:
+            stack[-1][6] = cut
+        return res
+
+    def expand_part(part):
+        """展开某个部件，直到落到字根表或失败；返回字根编码元组或 None
+
+        用显式栈代替递归，栈帧为 [部件, 拆分方式迭代器, 子部件迭代器, 已得编码,
+        待取结果的子部件, 进入次序, 子树中截断处的最早进入次序]。
+        """
+        # 快速路径：绝大多数调用直接命中缓存
+        hit = cache.get(part)
+        if hit is not None:
+            return hit[0]
+        code = rootmap.get(part)
+        if code is not None:
+            cache[part] = ((code,), frozenset())
+            return (code,)
+
+        # 异常中断时也要清空，否则残留的部件会被后续展开误判为已访问
+        try:
+            enter(part)
+            stack = [[part, iter(decomposition.get(part, ())), None, None, None, 0, 0]]
+            res = None  # 最近出栈的部件的展开结果
+            while stack:
+                frame = stack[-1]
+                name, alts, subs, codes, pending, start, cut = frame
+
+                if pending is not None:
+                    # 子部件刚展开完，结果即 res
+                    frame[4] = None
+                else:
+                    if subs is None:
+                        sub_parts = next(alts, None)
+                        if sub_parts is None:
+                            # 无法继续拆分 → 记入缺失字根
+                            missing_roots.add(name)
+                            res = leave(stack, None)
+                            continue
+                        subs = frame[2] = iter(apply_replacements(sub_parts))
+                        codes = frame[3] = []
+
+                    sp = next(subs, _UNKNOWN)
+                    if sp is _UNKNOWN:
+                        # 当前拆分方式的所有子部件均展开成功
+                        res = leave(stack, tuple(codes))
+                        continue
+
+                    code = rootmap.get(sp)
+                    if code is not None:
+                        res = (code,)
+                    elif sp in visited:
+                        res = None  # 避免死循环
+                        frame[6] = min(cut, visited[sp])
+                    else:
+                        hit = cache.get(sp)
+                        if hit is not None and visited.keys().isdisjoint(hit[1]):
+                            res = hit[0]
+                            for p in hit[1]:
+                                enter(p)
+                        else:
+                            frame[4] = sp
+                            enter(sp)
+                            n = len(order) - 1
+                            stack.append([sp, iter(decomposition.get(sp, ())),
+                                          None, None, None, n, n])
+                            continue
+
                 if res is None:
-                    success = False
-                    break
-                expanded.extend(res)
-            if success:
-                return expanded
+                    frame[2] = None  # 换下一种拆分方式
+                else:
+                    codes.extend(res)
+        finally:
+            visited.clear()
+            order.clear()
+        return res
 
-    # 无法继续拆分 → 记入缺失字根
-    missing_roots.add(part)
-    return None
+    return expand_part
 
 
-def get_code_for_decomp(parts, decomposition, rootmap, missing_roots, singlecode_chars, char):
+def get_code_for_decomp(parts, expand_part, singlecode_chars, char):
     """获取某种拆分方式的编码"""
-    expanded = []
+    # 取码只需首二三末：前三码之后只记末码和总数，不再拼接中间部分
+    # （中间部件仍需展开——任一部件失败则整个拆分失败——但展开结果已缓存）
+    head = []
+    last = None
+    total = 0
     for p in apply_replacements(parts):
-        res = expand_part(p, decomposition, rootmap, set(), missing_roots)
+        res = expand_part(p)
         if res is None:
             return None
-        expanded.extend(res)
+        if res:
+            total += len(res)
+            if len(head) < 3:
+                head.extend(res[:3 - len(head)])
+            last = res[-1]
 
-    codes = [rootmap[p] for p in expanded if p in rootmap]
-    if not codes:
+    if not total:
         return None
 
     # 如果拆分结果只有 1 位编码 → 视为失败
-    if len(codes) == 1:
+    if total == 1:
         singlecode_chars.append((char, "".join(parts)))
         return None
 
     # 取码逻辑：首二三末
-    if len(codes) >= 4:
-        return codes[0] + codes[1] + codes[2] + codes[-1]
+    if total >= 4:
+        return f"{head[0]}{head[1]}{head[2]}{last}"
     else:
-        return "".join(codes)
+        return "".join(head)
 
 
 # ===== 主程序 =====
@@ -110,31 +239,37 @@ def main():
 
     missing_roots = set()
     singlecode_chars = []
+    expand_part = make_expander(decomposition, rootmap, missing_roots)
 
-    missing_lines = []  # 暂存缺失日志
+    missing_chars = []  # 暂存缺失字（日志在最后按需格式化）
 
-    with open(OUTPUT_FILE, "w", encoding="utf-8") as fout:
+    with open(OUTPUT_FILE, "w", encoding="utf-8", buffering=WRITE_BUFFER) as fout:
+        batch = []
         for char, decomps in decomposition.items():
             success = False
             for parts in decomps:
-                code = get_code_for_decomp(parts, decomposition, rootmap,
-                                           missing_roots, singlecode_chars, char)
+                code = get_code_for_decomp(parts, expand_part,
+                                           singlecode_chars, char)
                 if code:
-                    fout.write(f"{char}\t{code}\n")
+                    batch.append(f"{char}\t{code}\n")
                     success = True
             if not success:
-                for parts in decomps:
-                    missing_lines.append(f"{char}\t{''.join(parts)}\n")
+                missing_chars.append(char)
+            if len(batch) >= WRITE_BATCH:
+                fout.writelines(batch)
+                batch.clear()
+        fout.writelines(batch)
 
     # 写缺失字根日志
-    with open(MISSING_LOG, "w", encoding="utf-8") as flog:
+    with open(MISSING_LOG, "w", encoding="utf-8", buffering=WRITE_BUFFER) as flog:
         flog.write("".join(sorted(missing_roots)) + "\n")
-        flog.writelines(missing_lines)
+        flog.writelines(f"{char}\t{''.join(parts)}\n"
+                        for char in missing_chars
+                        for parts in decomposition[char])
 
     # 写单码失败日志
-    with open(SINGLECODE_LOG, "w", encoding="utf-8") as slog:
-        for char, parts in singlecode_chars:
-            slog.write(f"{char}\t{parts}\n")
+    with open(SINGLECODE_LOG, "w", encoding="utf-8", buffering=WRITE_BUFFER) as slog:
+        slog.writelines(f"{char}\t{parts}\n" for char, parts in singlecode_chars)
 
 
 if __name__ == "__main__":
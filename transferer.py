@@ -10,15 +10,18 @@
 """
 
 from __future__ import annotations
+import mmap
+import os
 import re
-from typing import Dict, List, Tuple, Set
-from collections import defaultdict
+from typing import Dict, List, Optional, Tuple, Set
+from functools import lru_cache
 
 # ========== 路径配置（请按需修改） ==========
 SHAPE_FILE = "./output.txt"     # 上一步输出：每行“汉字<TAB>形码”
 PINYIN_DB_FILE = "./zdic.txt"       # Github 拼音库：每行“U+XXXX: pīnyīn”
 OUT_FILE = "./xhe_final_yinxing.txt"     # 输出“汉字<TAB>音形码”
 ERR_LOG = "./xhe_generate_error.log"     # 辅助日志
+WRITE_BUFFER = 1 << 20                   # 输出文件缓冲区大小
 # ===========================================
 
 # 你提供的小鹤双拼表（v 表示 ü）
@@ -73,11 +76,10 @@ _TONE_MAP = str.maketrans({
     "ḿ":"m"
 })
 
+@lru_cache(maxsize=4096)
 def _remove_tone(s: str) -> str:
-    s = s.strip().translate(_TONE_MAP)
-    # 删除数字声调（如 ni3）
-    s = re.sub(r"\d+$", "", s)
-    return s
+    # 去调号后删除末尾数字声调（如 ni3）
+    return s.strip().translate(_TONE_MAP).rstrip("0123456789")
 
 def _build_xiaohe_map(raw: str) -> Dict[str, str]:
     """
@@ -98,16 +100,28 @@ def _build_xiaohe_map(raw: str) -> Dict[str, str]:
 
 _XH = _build_xiaohe_map(_RAW_XIAOHE)
 
+# 预编译的最长匹配正则（候选按长度降序，re 取第一个命中的分支）
+def _longest_first(tokens) -> str:
+    return "|".join(map(re.escape, sorted(tokens, key=lambda s: -len(s))))
+
+_INITIAL_RE = re.compile(f"({_longest_first(_INITIALS)})?(.*)", re.DOTALL)
+# 从左向右搜索，第一个命中的即为最长后缀（\Z 锚定真正的串尾，不受末尾换行影响）
+_FINAL_RE = re.compile(rf"(?:{_longest_first(_XH)})\Z")
+
+def _match_final_suffix(final: str) -> Optional[str]:
+    """
+    后缀最长匹配韵母键，匹配不到返回 None
+    """
+    m = _FINAL_RE.search(final)
+    return _XH[m.group()] if m else None
+
 def _split_initial_final(pinyin: str) -> Tuple[str, str]:
     """
     最长匹配声母，返回 (initial, final)
     若找不到声母（以元音开头）→ initial=""
     """
-    p = pinyin
-    for init in sorted(_INITIALS, key=lambda s: -len(s)):
-        if p.startswith(init):
-            return init, p[len(init):]
-    return "", p
+    m = _INITIAL_RE.match(pinyin)
+    return m.group(1) or "", m.group(2)
 
 def _xiaohe_double_for_zero_initial(final: str) -> Tuple[str, str]:
     """
@@ -127,10 +141,7 @@ def _xiaohe_double_for_zero_initial(final: str) -> Tuple[str, str]:
     if final in _XH:
         second = _XH[final]
     else:
-        for k in sorted(_XH.keys(), key=lambda s: -len(s)):
-            if final.endswith(k):  # 后缀最长匹配
-                second = _XH[k]
-                break
+        second = _match_final_suffix(final)  # 后缀最长匹配
         if second is None:
             # 实在匹配不到，保底：用首字母
             second = final[0]
@@ -138,6 +149,7 @@ def _xiaohe_double_for_zero_initial(final: str) -> Tuple[str, str]:
     first = final[0]
     return first, second
 
+@lru_cache(maxsize=1024)
 def _xiaohe_double(pinyin: str) -> Tuple[str, str]:
     """
     将不带声调、已 ü→v 的拼音，转换为小鹤双拼的两码（字母、字母）
@@ -165,11 +177,7 @@ def _xiaohe_double(pinyin: str) -> Tuple[str, str]:
     if fin in _XH:
         second = _XH[fin]
     else:
-        matched = None
-        for k in sorted(_XH.keys(), key=lambda s: -len(s)):
-            if fin.endswith(k):
-                matched = _XH[k]
-                break
+        matched = _match_final_suffix(fin)
         second = matched if matched else (fin[0] if fin else "")
 
     if not first or not second:
@@ -182,7 +190,8 @@ def _load_shape_table(path: str) -> Dict[str, List[str]]:
     读取形码表：每行“汉字<TAB>形码”
     返回：汉字 -> [形码...]
     """
-    mp: Dict[str, List[str]] = defaultdict(list)
+    mp: Dict[str, List[str]] = {}
+    setdefault = mp.setdefault
     with open(path, "r", encoding="utf-8") as f:
         for ln, line in enumerate(f, 1):
             line = line.rstrip("\n\r")
@@ -191,107 +200,133 @@ def _load_shape_table(path: str) -> Dict[str, List[str]]:
             parts = line.split("\t")
             if len(parts) < 2:
                 raise ValueError(f"形码表第{ln}行格式错误：{line}")
-            ch, code = parts[0], parts[1]
-            mp[ch].append(code)
+            setdefault(parts[0], []).append(parts[1])
     return mp
 
+# 拼音库行格式：行首“U+XXXX: 读音”，# 之后为注释（按字节匹配，直接扫描 mmap）
+_PINYIN_LINE_RE = re.compile(
+    rb"^[^\S\n]*U\+([0-9A-Fa-f]+)[^\S\n]*:[^\S\n]*([^#\n]+)", re.MULTILINE
+)
+
 def _load_pinyin_db(path: str) -> Dict[str, List[str]]:
     """
     读取拼音库：每行“U+XXXX: pīnyīn  [# 注释]”
     忽略空行和 # 之后内容；去调、ü→v；多读音去重保序。
     返回：汉字 -> [pinyin...]
     """
-    mp: Dict[str, List[str]] = defaultdict(list)
-    with open(path, "r", encoding="utf-8") as f:
-        for ln, line in enumerate(f, 1):
-            line = line.split("#", 1)[0].strip()
-            if not line:
-                continue
-            m = re.match(r"U\+([0-9A-Fa-f]+)\s*:\s*(.+)$", line)
-            if not m:
-                # 非法行跳过
+    mp: Dict[str, List[str]] = {}
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return mp  # 空文件无法 mmap
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            # 非法行不会被匹配，自然跳过
+            for m in _PINYIN_LINE_RE.finditer(data):
+                try:
+                    ch = chr(int(m.group(1), 16))
+                except Exception:
+                    continue
+                # 只解码读音部分
+                payload = m.group(2).decode("utf-8").strip()
+
+                # 逗号分隔多个候选，再按空白细分
+                raw_list: List[str] = []
+                for block in payload.split(","):
+                    block = block.strip()
+                    if not block:
+                        continue
+                    for token in block.split():
+                        token = token.strip()
+                        if token:
+                            raw_list.append(token)
+
+                # 归一：去调、转小写、ü→v
+                norm_list: List[str] = []
+                for p in raw_list:
+                    p0 = _remove_tone(p).lower().replace("ü", "v")
+                    if p0:
+                        norm_list.append(p0)
+
+                # 去重保序后加入
+                seen: Set[str] = set()
+                uniq: List[str] = []
+                for p in norm_list:
+                    if p not in seen:
+                        seen.add(p)
+                        uniq.append(p)
+                if uniq:
+                    mp.setdefault(ch, []).extend(uniq)
+    return mp
+
+def _build_py2sp(pinyin_map: Dict[str, List[str]]) -> Dict[str, str]:
+    """
+    对拼音库中出现的每个不同拼音只转换一次，返回 拼音 -> 双拼两码
+    无法转换的拼音不入表
+    """
+    py2sp: Dict[str, str] = {}
+    failed: Set[str] = set()
+    for pinyins in pinyin_map.values():
+        for p in pinyins:
+            if p in py2sp or p in failed:
                 continue
-            code_hex = m.group(1)
-            payload = m.group(2).strip()
             try:
-                ch = chr(int(code_hex, 16))
+                a, b = _xiaohe_double(p)
             except Exception:
+                failed.add(p)
                 continue
+            py2sp[p] = f"{a}{b}"
+    return py2sp
 
-            # 逗号分隔多个候选，再按空白细分
-            raw_list: List[str] = []
-            for block in payload.split(","):
-                block = block.strip()
-                if not block:
-                    continue
-                for token in block.split():
-                    token = token.strip()
-                    if token:
-                        raw_list.append(token)
-
-            # 归一：去调、转小写、ü→v
-            norm_list: List[str] = []
-            for p in raw_list:
-                p0 = _remove_tone(p).lower().replace("ü", "v")
-                if p0:
-                    norm_list.append(p0)
-
-            # 去重保序后加入
-            seen: Set[str] = set()
-            uniq: List[str] = []
-            for p in norm_list:
-                if p not in seen:
-                    seen.add(p)
-                    uniq.append(p)
-            if uniq:
-                mp[ch].extend(uniq)
-    return mp
-
-def main():
-    shape_map = _load_shape_table(SHAPE_FILE)      # 汉字 -> [形码...]
-    pinyin_map = _load_pinyin_db(PINYIN_DB_FILE)   # 汉字 -> [拼音...]
-
-    out_lines: List[str] = []
-    missing_pinyin: Set[str] = set()
-    cannot_convert: List[Tuple[str, str]] = []  # (汉字, 拼音)
-
-    # 逐字处理（保证同一汉字的行连续：先收集再统一 append）
+def _check_shape_lengths(shape_map: Dict[str, List[str]],
+                         pinyin_map: Dict[str, List[str]]) -> None:
+    """
+    形码长度检查：若有拼音的汉字存在长度为 1 的形码，写错误日志并立即退出
+    （在打开输出文件前完成，保证出错时不写输出）
+    """
     for ch, shape_list in shape_map.items():
-        pinyins = pinyin_map.get(ch)
-        if not pinyins:
-            # 形码表里有，但拼音库没有
-            missing_pinyin.add(ch)
+        if not pinyin_map.get(ch):
             continue
-
-        char_lines: List[str] = []
-
         for shape in shape_list:
-            # 形码长度检查：若为 1，立即报错退出
             if len(shape) < 2:
-                # 立刻报错（不写输出）
                 with open(ERR_LOG, "w", encoding="utf-8") as ef:
                     ef.write("ERROR: 发现形码长度为 1 的条目，需回到上一步修正拆分/字根。\n")
                     ef.write(f"{ch}\t{shape}\n")
                 raise SystemExit(f"形码长度为 1：{ch} -> {shape}（已写入 {ERR_LOG}）")
 
-            # 形码后两位：首 + 末
-            s_first, s_last = shape[0], shape[-1]
+def main():
+    shape_map = _load_shape_table(SHAPE_FILE)      # 汉字 -> [形码...]
+    pinyin_map = _load_pinyin_db(PINYIN_DB_FILE)   # 汉字 -> [拼音...]
+    _check_shape_lengths(shape_map, pinyin_map)
+    py2sp = _build_py2sp(pinyin_map)               # 拼音 -> 双拼两码
+
+    out_count = 0
+    missing_pinyin: Set[str] = set()
+    cannot_convert: List[Tuple[str, str]] = []  # (汉字, 拼音)
+
+    # 逐字处理并直接写出（同一汉字的行自然连续）
+    with open(OUT_FILE, "w", encoding="utf-8", buffering=WRITE_BUFFER) as fo:
+        for ch, shape_list in shape_map.items():
+            pinyins = pinyin_map.get(ch)
+            if not pinyins:
+                # 形码表里有，但拼音库没有
+                missing_pinyin.add(ch)
+                continue
+
+            # 形码后两位：首 + 末（与拼音无关，先算好）
+            shape_tails = [f"{shape[0]}{shape[-1]}" for shape in shape_list]
 
+            # 前两位：查预先算好的双拼表
+            heads: List[str] = []
             for p in pinyins:
-                try:
-                    a, b = _xiaohe_double(p)  # 前两位
-                except Exception:
+                head = py2sp.get(p)
+                if head is None:
                     cannot_convert.append((ch, p))
                     continue
-                full = a + b + s_first + s_last
-                char_lines.append(f"{ch}\t{full}")
-
-        out_lines.extend(char_lines)
+                heads.append(head)
 
-    # 写输出
-    with open(OUT_FILE, "w", encoding="utf-8") as fo:
-        for line in out_lines:
-            fo.write(line + "\n")
+            for tail in shape_tails:
+                for head in heads:
+                    fo.write(f"{ch}\t{head}{tail}\n")
+            out_count += len(shape_tails) * len(heads)
 
     # 写辅助日志
     with open(ERR_LOG, "w", encoding="utf-8") as ef:
@@ -303,9 +338,9 @@ def main():
             for ch, p in cannot_convert:
                 ef.write(f"{ch}\t{p}\n")
             ef.write("\n")
-        ef.write(f"SUMMARY: 输出行数 = {len(out_lines)}\n")
+        ef.write(f"SUMMARY: 输出行数 = {out_count}\n")
 
-    print(f"完成。输出 {len(out_lines)} 行到 {OUT_FILE}；详情见 {ERR_LOG}。")
+    print(f"完成。输出 {out_count} 行到 {OUT_FILE}；详情见 {ERR_LOG}。")
     if missing_pinyin:
         print(f"注意：有 {len(missing_pinyin)} 个汉字在拼音库中缺失拼音（见 {ERR_LOG}）。")
     if cannot_convert: